@@ -1,24 +1,95 @@
 import csv
+import gzip
+import io
 import subprocess
 import concurrent.futures
+import heapq
+import itertools
 import os
+import signal
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Processes started per batch number, so the copy of a batch that loses a
+# speculative race can be killed as soon as the other copy finishes
+process_lock = threading.Lock()
+batch_processes = {}
+finished_batches = set()
+
+class BatchCancelled(Exception):
+    pass
+
+# ----------------------------------------------------------------
+# Function: run_command
+# Purpose: Run a command like subprocess.run(check=True), registered under
+#          batch_num in its own process group so finish_batch() can kill it.
+#          Raises BatchCancelled if the batch was finished by another copy.
+# ----------------------------------------------------------------
+def run_command(command, batch_num, timeout):
+    with process_lock:
+        if batch_num in finished_batches:
+            raise BatchCancelled(batch_num)
+        process = subprocess.Popen(
+            command, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            text=True, start_new_session=True
+        )
+        batch_processes.setdefault(batch_num, []).append(process)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        kill_process(process)
+        process.communicate()
+        raise
+    finally:
+        with process_lock:
+            batch_processes[batch_num].remove(process)
+    if batch_num in finished_batches:
+        raise BatchCancelled(batch_num)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return stdout
+
+# ----------------------------------------------------------------
+# Function: kill_process
+# Purpose: Kill a command together with everything in its process group
+# ----------------------------------------------------------------
+def kill_process(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+# ----------------------------------------------------------------
+# Function: finish_batch
+# Purpose: Mark a batch as done and kill any other copy still running it
+# ----------------------------------------------------------------
+def finish_batch(batch_num):
+    with process_lock:
+        finished_batches.add(batch_num)
+        for process in batch_processes.get(batch_num, []):
+            kill_process(process)
 
 # ----------------------------------------------------------------
 # Function: fetch_sequences
 # Purpose: For a list of accession IDs, fetch corresponding sequences
 #          from the local BLAST database and write them to a FASTA file.
 # ----------------------------------------------------------------
-def fetch_sequences(batch_accessions, db_path, fasta_file):
+def fetch_sequences(batch_accessions, db_path, fasta_file, batch_num, timeout):
     with open(fasta_file, "w") as f_out:
         for acc in batch_accessions:
             try:
                 # Using blastdbcmd to fetch sequence by accession ID
-                result = subprocess.run(
+                result = run_command(
                     ['blastdbcmd', '-db', db_path, '-entry', acc, '-outfmt', '%f'],
-                    capture_output=True, text=True, check=True
+                    batch_num, timeout
                 )
                 # Append to the batch FASTA file
-                f_out.write(result.stdout)
+                f_out.write(result)
             except subprocess.CalledProcessError:
                 # If sequence not found or any error, skip it
                 print(f"[Warning] Could not fetch sequence for accession: {acc}")
@@ -28,7 +99,7 @@ def fetch_sequences(batch_accessions, db_path, fasta_file):
 # Purpose: Run blastn on the given FASTA file and return parsed results.
 #          The result is a list of rows, where each row is a list of BLAST fields.
 # ----------------------------------------------------------------
-def run_blast_and_parse(fasta_file, db_path):
+def run_blast_and_parse(fasta_file, db_path, batch_num, timeout):
     # These are the fields we want in the BLAST output (format 6 = tab-delimited)
     outfmt_fields = [
         "qseqid", "qgi", "qacc", "qaccver", "qlen", "sseqid", "sallseqid", "sgi", "sallgi",
@@ -42,13 +113,13 @@ def run_blast_and_parse(fasta_file, db_path):
     outfmt_string = "6 " + " ".join(outfmt_fields)
 
     # Run blastn with the given output format
-    result = subprocess.run(
+    result = run_command(
         ['blastn', '-query', fasta_file, '-db', db_path, '-outfmt', outfmt_string],
-        capture_output=True, text=True, check=True
+        batch_num, timeout
     )
 
     # Split the output into lines and then fields
-    lines = result.stdout.strip().split('\n')
+    lines = result.strip().split('\n')
     parsed_rows = [line.split('\t') for line in lines if line.strip()]
 
     # Wrap the last two columns (stitle, salltitles) in quotes for clean CSV formatting
@@ -63,47 +134,167 @@ def run_blast_and_parse(fasta_file, db_path):
 # Function: process_batch
 # Purpose: Fetch sequences, run BLAST, parse results for a single batch
 # ----------------------------------------------------------------
-def process_batch(batch_accessions, db_path, batch_num):
-    # Temporary FASTA file name for this batch
-    fasta_file = f"batch_{batch_num}.fasta"
-
-    print(f"[Batch {batch_num}] Fetching {len(batch_accessions)} sequences...")
-    fetch_sequences(batch_accessions, db_path, fasta_file)
-
-    print(f"[Batch {batch_num}] Running BLAST...")
-    blast_results = run_blast_and_parse(fasta_file, db_path)
+def process_batch(batch_accessions, db_path, batch_num, timeout):
+    # Temporary FASTA file name for this batch (per thread, a speculative
+    # copy of the same batch may be running at the same time)
+    fasta_file = f"batch_{batch_num}_{threading.get_ident()}.fasta"
 
-    # Clean up temporary file
     try:
-        os.remove(fasta_file)
-    except OSError:
-        pass
+        print(f"[Batch {batch_num}] Fetching {len(batch_accessions)} sequences...")
+        fetch_sequences(batch_accessions, db_path, fasta_file, batch_num, timeout)
+
+        print(f"[Batch {batch_num}] Running BLAST...")
+        blast_results = run_blast_and_parse(fasta_file, db_path, batch_num, timeout)
+    finally:
+        # Clean up temporary file
+        try:
+            os.remove(fasta_file)
+        except OSError:
+            pass
 
     print(f"[Batch {batch_num}] Completed. Found {len(blast_results)} hits.")
     return blast_results
 
+# ----------------------------------------------------------------
+# Function: open_input
+# Purpose: Open an input table for reading, decompressing .gz/.zst files
+#          on the fly (same suffixes as open_table() in new_extraction)
+# ----------------------------------------------------------------
+def open_input(path):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", newline='')
+    if path.endswith(".zst"):
+        if zstandard is None:
+            print(f"[Error] The zstandard package is required to read {path}")
+            exit(1)
+        stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        return io.TextIOWrapper(stream, newline='')
+    return open(path, newline='')
+
+# ----------------------------------------------------------------
+# Function: load_accessions
+# Purpose: Read (accession, sequence length) pairs. Accepts either the
+#          adding_parent() TSV, possibly compressed (uses its accession
+#          and sequence_length columns), or a plain CSV with one accession
+#          ID per row, in which case every length is unknown and counted as 0.
+# ----------------------------------------------------------------
+def load_accessions(input_file):
+    with open_input(input_file) as f:
+        # Compressed streams cannot seek back, so parse the first line ourselves
+        first_line = f.readline()
+        if "\t" in first_line and "sequence_length" in first_line:
+            header = next(csv.reader([first_line], delimiter='\t'))
+            reader = csv.DictReader(f, fieldnames=header, delimiter='\t')
+            return [
+                (row["accession"].strip(), int(row["sequence_length"]) if row["sequence_length"].isdigit() else 0)
+                for row in reader if row["accession"]
+            ]
+        reader = csv.reader(itertools.chain([first_line], f))
+        return [(row[0].strip(), 0) for row in reader if row]
+
+# ----------------------------------------------------------------
+# Function: plan_batches
+# Purpose: Bin-pack accessions into batches of roughly equal estimated
+#          blastn cost (sequence length plus a fixed per-query cost),
+#          placing the longest queries first into the lightest batch, and
+#          return the batches heaviest first (LPT order) so the slowest
+#          work starts early and workers stay busy until the last batch.
+# ----------------------------------------------------------------
+def plan_batches(accessions, batch_size, per_query_cost):
+    num_batches = -(-len(accessions) // batch_size)
+    heap = [(0, idx, []) for idx in range(num_batches)]
+    for acc, length in sorted(accessions, key=lambda item: item[1], reverse=True):
+        cost, idx, batch = heapq.heappop(heap)
+        batch.append(acc)
+        heapq.heappush(heap, (cost + length + per_query_cost, idx, batch))
+    return [batch for cost, idx, batch in sorted(heap, key=lambda item: item[0], reverse=True)]
+
+# ----------------------------------------------------------------
+# Function: timed_batch
+# Purpose: Run process_batch after an optional retry delay, recording when
+#          the batch started and how long it took so stragglers can be spotted
+# ----------------------------------------------------------------
+def timed_batch(batch_accessions, db_path, batch_num, timeout, delay, started):
+    time.sleep(delay)
+    begin = time.time()
+    started.setdefault(batch_num, begin)
+    results = process_batch(batch_accessions, db_path, batch_num, timeout)
+    return results, time.time() - begin
+
+# ----------------------------------------------------------------
+# Function: split_batch
+# Purpose: Submit the two halves of a batch as parts of it. The parts run
+#          alongside (or instead of) the batch itself; once every part has
+#          finished they complete the batch through complete_batch().
+# ----------------------------------------------------------------
+def split_batch(executor, futures, batch_num, batch, db_path, timeout, started, parents, children):
+    half = len(batch) // 2
+    children[batch_num] = []
+    for part, sub_batch in enumerate((batch[:half], batch[half:]), start=1):
+        sub_num = f"{batch_num}.{part}"
+        parents[sub_num] = batch_num
+        children[batch_num].append(sub_num)
+        futures[executor.submit(timed_batch, sub_batch, db_path, sub_num, timeout, 0, started)] = (sub_num, sub_batch, 0)
+
+# ----------------------------------------------------------------
+# Function: cancel_batch
+# Purpose: Finish a batch and every part split from it, killing whatever
+#          is still running for them
+# ----------------------------------------------------------------
+def cancel_batch(batch_num, children):
+    finish_batch(batch_num)
+    for part in children.get(batch_num, []):
+        cancel_batch(part, children)
+
+# ----------------------------------------------------------------
+# Function: complete_batch
+# Purpose: Record the results of a batch. A part's results are held until
+#          all parts of its batch are in, which then completes that batch.
+#          Returns (batch number, results) once a top-level batch is
+#          complete and should be written, otherwise None.
+# ----------------------------------------------------------------
+def complete_batch(batch_num, results, parents, children, part_results):
+    while True:
+        cancel_batch(batch_num, children)
+        parent = parents.get(batch_num)
+        if parent is None:
+            return batch_num, results
+        if parent in finished_batches:
+            return None
+        done_parts = part_results.setdefault(parent, {})
+        done_parts[batch_num] = results
+        if len(done_parts) < len(children[parent]):
+            return None
+        results = [row for part in children[parent] for row in done_parts[part]]
+        batch_num = parent
+
 # ----------------------------------------------------------------
 # Function: main
 # Purpose: Read accessions, batch them, process in parallel, write to CSV
 # ----------------------------------------------------------------
 def main():
     # --- Configuration ---
-    input_csv = "accessions.csv"           # CSV with one accession ID per row
+    input_csv = "accessions.csv"           # CSV with one accession ID per row, or the adding_parent() TSV
     output_csv = "blast_results.csv"       # Final output file
     blast_db_path = "your_blast_db"        # Path to local BLAST database
-    batch_size = 50                        # How many accessions per batch
+    batch_size = 50                        # Average number of accessions per batch
+    per_query_cost = 300                   # Fixed cost per accession, in sequence letters
     max_workers = 14                       # Number of parallel threads to use
+    blast_timeout = 3600                   # Seconds before a blastdbcmd/blastn call is killed
+    max_retries = 2                        # Extra attempts for a failed batch (not for timeouts)
+    retry_backoff = 10                     # Seconds before the first retry, doubled every retry
+    speculation_factor = 4.0               # Split batches slower than this many median batches
+    speculation_min_samples = 10           # Finished batches needed before speculating
+    poll_interval = 5                      # Seconds between scheduler checks
 
-    # --- Step 1: Load accession IDs from CSV ---
-    with open(input_csv, newline='') as f:
-        reader = csv.reader(f)
-        accession_ids = [row[0].strip() for row in reader if row]
+    # --- Step 1: Load accession IDs (and sequence lengths when known) ---
+    accessions = load_accessions(input_csv)
 
-    print(f"[Info] Loaded {len(accession_ids)} accession IDs.")
+    print(f"[Info] Loaded {len(accessions)} accession IDs.")
 
-    # --- Step 2: Split into batches ---
-    batches = [accession_ids[i:i+batch_size] for i in range(0, len(accession_ids), batch_size)]
-    print(f"[Info] Created {len(batches)} batches of size ~{batch_size}.")
+    # --- Step 2: Pack into batches of equal estimated cost, largest first ---
+    batches = plan_batches(accessions, batch_size, per_query_cost)
+    print(f"[Info] Created {len(batches)} batches of ~{batch_size} accessions, balanced by sequence length.")
 
     # --- Step 3: Define BLAST output fields (same as in parsing) ---
     header_fields = [
@@ -123,23 +314,91 @@ def main():
     # --- Step 4: Process batches in parallel using ThreadPool ---
     # We use threads because BLAST runs in subprocesses (I/O-bound),
     # and ThreadPool works better in this case than ProcessPool on many systems.
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+    # Each future maps to (batch number, accessions, attempt). Once the queue
+    # has drained, a batch running longer than speculation_factor x the median
+    # is split in half and both halves run speculatively next to it; a batch
+    # that hits blast_timeout is split the same way. Whichever finishes first,
+    # the batch or all of its parts, is written and the rest is killed, so a
+    # pathological sequence ends up alone in a small batch. Failures are
+    # retried with exponential backoff, timeouts are not (they would only
+    # time out again).
+    started = {}
+    durations = []
+    parents = {}
+    children = {}
+    part_results = {}
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers)
+    try:
         futures = {
-            executor.submit(process_batch, batch, blast_db_path, idx): idx
+            executor.submit(timed_batch, batch, blast_db_path, idx, blast_timeout, 0, started): (idx, batch, 0)
             for idx, batch in enumerate(batches, start=1)
         }
 
         # Open output CSV in append mode to add results as they come in
         with open(output_csv, 'a', newline='', encoding='utf-8') as f_out:
             writer = csv.writer(f_out)
-            for future in concurrent.futures.as_completed(futures):
-                batch_num = futures[future]
-                try:
-                    results = future.result()
-                    writer.writerows(results)
-                    print(f"[Batch {batch_num}] Results written to CSV.")
-                except Exception as e:
-                    print(f"[Error] Batch {batch_num} failed: {e}")
+            while futures:
+                done, _ = concurrent.futures.wait(
+                    futures, timeout=poll_interval, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    batch_num, batch, attempt = futures.pop(future)
+                    if batch_num in finished_batches:
+                        # The batch or the batch it was split from is already complete
+                        continue
+                    duration = None
+                    try:
+                        results, duration = future.result()
+                    except BatchCancelled:
+                        continue
+                    except subprocess.TimeoutExpired:
+                        if batch_num in children:
+                            # Its parts are already running and will complete it
+                            continue
+                        if len(batch) > 1:
+                            print(f"[Batch {batch_num}] Timed out, splitting into two smaller batches.")
+                            split_batch(executor, futures, batch_num, batch, blast_db_path, blast_timeout, started, parents, children)
+                            continue
+                        print(f"[Error] Batch {batch_num} timed out, giving up on accession {batch[0]}.")
+                        results = []
+                    except Exception as e:
+                        if batch_num in children:
+                            continue
+                        if attempt < max_retries:
+                            print(f"[Batch {batch_num}] Failed ({e}), retrying (attempt {attempt + 2}).")
+                            delay = retry_backoff * 2 ** attempt
+                            futures[executor.submit(timed_batch, batch, blast_db_path, batch_num, blast_timeout, delay, started)] = (batch_num, batch, attempt + 1)
+                            continue
+                        print(f"[Error] Batch {batch_num} failed: {e}")
+                        results = []
+                    if duration is not None:
+                        durations.append(duration)
+                    completed = complete_batch(batch_num, results, parents, children, part_results)
+                    if completed and completed[1]:
+                        writer.writerows(completed[1])
+                        print(f"[Batch {completed[0]}] Results written to CSV.")
+
+                # Stop waiting on batches that are complete, their processes have been killed
+                for other_future, (num, _, _) in list(futures.items()):
+                    if num in finished_batches:
+                        other_future.cancel()
+                        del futures[other_future]
+
+                # Speculate only once every queued batch has started and workers go idle
+                queued = any(num not in started for num, _, _ in futures.values())
+                if queued or len(durations) < speculation_min_samples:
+                    continue
+                threshold = speculation_factor * sorted(durations)[len(durations) // 2]
+                now = time.time()
+                for batch_num, batch, attempt in list(futures.values()):
+                    if batch_num in finished_batches or batch_num in children or attempt > 0 or len(batch) < 2:
+                        continue
+                    if now - started.get(batch_num, now) > threshold:
+                        print(f"[Batch {batch_num}] Running for {now - started[batch_num]:.0f}s, splitting it into two speculative halves.")
+                        split_batch(executor, futures, batch_num, batch, blast_db_path, blast_timeout, started, parents, children)
+    finally:
+        # Cancelled copies exit on their own, there is nothing left to wait for
+        executor.shutdown(wait=False, cancel_futures=True)
 
     print("[Done] All batches processed and results saved.")
 
@@ -1,23 +1,155 @@
 # importing files
 import csv
+import gzip
+import io
 import sqlite3
 import subprocess
 import concurrent.futures
 import threading
+import contextlib
+import itertools
 import os
+import sys
+import re
+import glob
+import mmap
+import shutil
+import signal
 import time
+import random
+import math
+import struct
+import bisect
 import pandas as pd
+from array import array
+from collections import Counter
 from datetime import datetime
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import xlsxwriter
+except ImportError:
+    xlsxwriter = None
+
+try:
+    import openpyxl
+    from openpyxl.cell import WriteOnlyCell
+except ImportError:
+    openpyxl = None
+
 # initializing variables
 name = "ITS_RefSeq_Fungi"
 extn = "tar.gz"
+compression = None          # None, "gzip" or "zstd" for the pipeline TSVs
+compression_level = 6
+compression_threads = 4     # zstd worker threads, 0 compresses on the writing thread
+table_suffix = {"gzip": ".gz", "zstd": ".zst"}.get(compression, "")
 db_name = f"./extracted_files/{name}/{name}"
-output_file = f"extracted_files/{name}/{name}.tsv"
-blastn_file = f"extracted_files/{name}/{name}-blastn.tsv"
+output_file = f"extracted_files/{name}/{name}.tsv{table_suffix}"
+blastn_file = f"extracted_files/{name}/{name}-blastn.tsv{table_suffix}"
 sql_file = f"./extracted_files/{name}/taxonomy4blast.sqlite3"
 blastn_lock = threading.Lock()
 
+# k-mer prefilter settings (opt-in accelerated blastn mode)
+use_prefilter = False               # restrict each blastn search to candidate subjects
+prefilter_k = 15                    # k-mer size used for minimizers
+prefilter_window = 10               # number of consecutive k-mers per minimizer window
+prefilter_candidates = 100          # candidate subjects passed to blastn per query
+prefilter_max_occurrence = 1000     # ignore minimizers shared by more sequences than this
+prefilter_recall_sample = 200       # queries re-run exhaustively for the recall report
+prefilter_dir = f"extracted_files/{name}/seqidlists"
+recall_file = f"extracted_files/{name}/{name}-prefilter-recall.tsv"
+prefilter_index = {}
+prefilter_accessions = []
+prefilter_db_letters = 0
+complement = str.maketrans("ACGTacgt", "TGCAtgca")
+
+# per-query summary settings
+summarize_hits = False              # reduce each query's hits to one summary row during blastn
+keep_full_hits = True               # also write every hit to blastn_file when summarizing
+summary_top_k = 5                   # subjects listed per query, ranked by bit score
+summary_min_identity = 97.0         # minimum percentage identity for the consensus
+summary_min_coverage = 90.0         # minimum query coverage per subject for the consensus
+summary_file = f"extracted_files/{name}/{name}-summary.tsv{table_suffix}"
+taxid_parents = {}
+taxdb_file = f"./extracted_files/{name}/taxdb"
+taxdb_taxids = array("I")
+taxdb_offsets = array("I")
+taxdb_names = b""
+
+# cluster-representative search settings (opt-in approximation)
+use_clusters = False                # run blastn for cluster representatives only
+cluster_identity = 0.97             # minimum estimated identity for joining a cluster
+cluster_candidates = 20             # representatives compared against each sequence
+cluster_file = f"extracted_files/{name}/{name}-clusters.tsv"
+projected_file = f"extracted_files/{name}/{name}-blastn-projected.tsv{table_suffix}"
+cluster_members = {}
+
+# straggler mitigation settings for the blastn stage
+task_timeout = 3600                 # seconds before a blastdbcmd/blastn call is killed, None waits forever
+task_retries = 2                    # extra attempts after a failure, timeouts are not retried
+retry_backoff = 10                  # seconds before the first retry, doubled on every retry
+speculation_factor = 4.0            # re-run tasks running this many times longer than the median task
+speculation_min_samples = 20        # finished tasks needed before speculating
+poll_interval = 5                   # seconds between scheduler checks
+task_lock = threading.Lock()
+task_processes = {}
+task_started = {}
+task_durations = []
+tasks_done = set()
+tasks_failed = set()
+
+# database staging settings for the blastn stage
+stage_db = None                     # None, "copy", "link" (hard link, copies across filesystems) or "touch"
+stage_dir = f"/dev/shm/{name}"      # RAM-backed directory for "copy"/"link", each run stages into its own subdirectory
+stage_run_dir = os.path.join(stage_dir, str(os.getpid()))
+stage_lock_pages = True             # keep touched volumes locked in RAM with vmtouch when installed
+stage_pid_file = f"/tmp/{name}-{os.getpid()}-vmtouch.pid"
+original_db_name = db_name
+staged_files = []
+stage_dir_created = False
+stage_run_dir_created = False
+vmtouch_started = False
+
+# xlsx export settings
+xlsx_max_rows = 1048576             # rows per sheet including the header, Excel's limit
+xlsx_max_sheets = 10                # sheets per workbook before a new workbook is started
+xlsx_max_cell = 32767               # characters per cell, longer values are truncated
+xlsx_profiles = {
+    "full": None,
+    "sequences_reduced": ["accession", "sequence_title", "sequence_length", "taxid", "scientific_name", "taxonomic_super_kingdom", "taxid_parent"],
+    "blastn_reduced": ["query_accession_version", "subject_accession_version", "percentage_identity", "alignment_length", "expect_value", "bit_score", "query_coverage_per_subject", "subject_taxid", "subject_scientific_name", "subject_title"],
+}
+# columns written as numbers in every profile, identifiers (accessions, gi, taxids) stay text
+xlsx_numeric_columns = {
+    "sequence_length", "query_sequence_length", "subject_sequence_length", "query_start", "query_end", "subject_start", "subject_end",
+    "expect_value", "bit_score", "raw_score", "alignment_length", "percentage_identity", "number_of_identical_matches", "number_of_mismatches",
+    "number_of_positive_scoring_matches", "number_of_gap_opens", "number_of_gaps", "percentage_of_positive_scoring_matches",
+    "query_coverage_per_subject", "query_coverage_per_hsp", "query_coverage_per_unique_subject",
+    "hit_count", "subject_count", "best_bit_score", "best_expect_value", "best_percentage_identity", "best_query_coverage_per_subject",
+    "consensus_subject_count", "cluster_estimated_identity",
+}
+
+# opening a pipeline TSV, compressing or decompressing on the fly based on its suffix
+def open_table(path, mode="r"):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", compresslevel=compression_level, newline="")
+    if path.endswith(".zst"):
+        if zstandard is None:
+            print(f"Error: the zstandard package is required to open {path}")
+            exit(1)
+        if mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        else:
+            compressor = zstandard.ZstdCompressor(level=compression_level, threads=compression_threads)
+            stream = compressor.stream_writer(open(path, mode + "b"))
+        return io.TextIOWrapper(stream, newline="")
+    return open(path, mode, newline="")
+
 # creating directory in the current directory
 def creating_directory():
     print(f"Creating directory named {name}\n")
@@ -48,17 +180,52 @@ def blasting():
         exit(1)
     print("Done. Entered into sample.tsv\n")
 
-# adding parent-taxid into new field and creating final tsv file
-def adding_parent():
-    print("Adding parent field to TSV file\n")
+# loading taxid -> parent taxid pairs from the taxonomy database
+def loading_taxonomy():
     conn = sqlite3.connect(sql_file)
     cursor = conn.cursor()
     print("Loading taxid info into memory for faster lookup...")
     cursor.execute("SELECT taxid, parent FROM TaxidInfo")
     taxid_dict = {str(taxid): str(parent) for taxid, parent in cursor.fetchall()}
     conn.close()
-    
-    with open("sample.tsv", mode="r", newline="") as infile, open(output_file, mode="w", newline="") as outfile:
+    return taxid_dict
+
+# loading the taxdb.bti index (big-endian taxid/offset pairs after a 24 byte header) and mapping taxdb.btd
+def loading_taxdb():
+    global taxdb_taxids, taxdb_offsets, taxdb_names
+    if not os.path.exists(f"{taxdb_file}.bti") or not os.path.exists(f"{taxdb_file}.btd"):
+        print(f"Warning: {taxdb_file}.bti/.btd not found, LCA names will only be filled when the LCA is a hit's taxid")
+        return
+    with open(f"{taxdb_file}.bti", "rb") as f:
+        index = f.read()
+    magic, count = struct.unpack(">II", index[:8])
+    if magic != 0x8739:
+        print(f"Warning: {taxdb_file}.bti is not a taxdb index, LCA names will only be filled when the LCA is a hit's taxid")
+        return
+    pairs = array("I", index[24:24 + 8 * count])
+    if sys.byteorder == "little":
+        pairs.byteswap()
+    taxdb_taxids, taxdb_offsets = pairs[0::2], pairs[1::2]
+    with open(f"{taxdb_file}.btd", "rb") as f:
+        taxdb_names = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+# looking up the scientific name of a taxid in taxdb
+def scientific_name(taxid):
+    if not taxid.isdigit():
+        return ""
+    i = bisect.bisect_left(taxdb_taxids, int(taxid))
+    if i == len(taxdb_taxids) or taxdb_taxids[i] != int(taxid):
+        return ""
+    end = taxdb_offsets[i + 1] if i + 1 < len(taxdb_offsets) else len(taxdb_names)
+    record = taxdb_names[taxdb_offsets[i]:end].decode("utf-8", errors="replace")
+    return record.split('\t')[0]
+
+# adding parent-taxid into new field and creating final tsv file
+def adding_parent():
+    print("Adding parent field to TSV file\n")
+    taxid_dict = loading_taxonomy()
+
+    with open("sample.tsv", mode="r", newline="") as infile, open_table(output_file, "w") as outfile:
         reader = csv.reader(infile)
         writer = csv.writer(outfile, delimiter='\t')
         header = ["ordinal_number", "accession", "sequence_id", "sequence_title", "sequence", "gi", "sequence_length", "sequence_hash_value", "taxid", "taxid_leaf", "membership_integer", "common_taxonomic_name", "common_taxonomic_name_leaf", "scientific_name", "scientific_name_leaf", "blast_name", "taxonomic_super_kingdom", "pig", "taxid_parent"]
@@ -73,55 +240,646 @@ def adding_parent():
     print(f"Added parent field. The new TSV file is {output_file}\n")
 
 # creating header for the blastn file
-def blastn_file_creation():
-    print(f"Creating {blastn_file} with header\n")
-    with open(blastn_file, mode="w", newline="") as write_file:
+def blastn_file_creation(path=None, extra_columns=()):
+    path = path or blastn_file
+    print(f"Creating {path} with header\n")
+    with open_table(path, "w") as write_file:
         writer = csv.writer(write_file, delimiter='\t')
         header = ["query_sequence_id", "query_gi", "query_accession", "query_accession_version", "query_sequence_length", "subject_sequence_id", "subject_all_sequence_id", "subject_gi", "subject_all_gi", "subject_accession", "subject_accession_version", "subject_all_accession", "subject_sequence_length", "query_start", "query_end", "subject_start", "subject_end", "query_sequence", "subject_sequence", "expect_value", "bit_score", "raw_score", "alignment_length", "percentage_identity", "number_of_identical_matches", "number_of_mismatches", "number_of_positive_scoring_matches", "number_of_gap_opens", "number_of_gaps", "percentage_of_positive_scoring_matches", "query/subject_frame", "query_frames", "subject_frames", "blast_traceback_operations", "subject_taxid", "subject_scientific_name", "subject_common_name", "subject_blast_name", "subject_super_kingdom", "subject_all_taxids", "subject_all_scientific_names", "subject_all_common_names", "subject_all_blast_names", "subject_all_super_kingdoms", "subject_strand", "query_coverage_per_subject", "query_coverage_per_hsp", "query_coverage_per_unique_subject", "subject_title", "subject_all_titles"]
-        writer.writerow(header)
-    print(f"Successfully created {blastn_file} with header\n")
+        writer.writerow(header + list(extra_columns))
+    print(f"Successfully created {path} with header\n")
 
-# worker function for blastn()
-def run_blastn_for_accession(row):
-    accession = row[1]
+# creating header for the per-query summary file
+def summary_file_creation():
+    print(f"Creating {summary_file} with header\n")
+    summary_out = open_table(summary_file, "w")
+    writer = csv.writer(summary_out, delimiter='\t')
+    header = ["query_accession_version", "query_sequence_length", "hit_count", "subject_count", "best_subject_accession_version", "best_bit_score", "best_expect_value", "best_percentage_identity", "best_query_coverage_per_subject", "best_subject_taxid", "best_subject_scientific_name", "top_subject_accession_versions", "top_bit_scores", "consensus_subject_count", "consensus_lca_taxid", "consensus_lca_scientific_name", "cluster_representative", "cluster_estimated_identity"]
+    writer.writerow(header)
+    return summary_out
+
+# walking a taxid up to the root of the taxonomy
+def lineage(taxid):
+    path = []
+    while taxid and taxid != "0" and taxid not in path:
+        path.append(taxid)
+        taxid = taxid_parents.get(taxid)
+    return path
+
+# finding the deepest taxid shared by the lineages of all given taxids
+def lowest_common_ancestor(taxids):
+    common = None
+    for taxid in taxids:
+        ancestors = lineage(taxid)
+        if common is None:
+            common = ancestors
+        else:
+            shared = set(ancestors)
+            common = [t for t in common if t in shared]
+    return common[0] if common else ""
+
+# reducing the blastn hits of one query to a single summary row
+def summarize_query(query, query_length, hits, representative="", identity=""):
+    if not hits:
+        return [query, query_length, 0, 0] + [""] * 12 + [representative, identity]
+    query, query_length = hits[0][3], hits[0][4]
+    # keep the best scoring HSP of every subject
+    best_per_subject = {}
+    for hit in hits:
+        current = best_per_subject.get(hit[10])
+        if current is None or float(hit[20]) > float(current[20]):
+            best_per_subject[hit[10]] = hit
+    ranked = sorted(best_per_subject.values(), key=lambda hit: float(hit[20]), reverse=True)
+    best = ranked[0]
+    top = ranked[:summary_top_k]
+    consensus = [hit for hit in ranked if float(hit[23]) >= summary_min_identity and float(hit[45]) >= summary_min_coverage]
+    taxids = {taxid for hit in consensus for taxid in hit[39].split(';') if taxid}
+    lca = lowest_common_ancestor(taxids)
+    lca_name = scientific_name(lca) or next((hit[35] for hit in consensus if hit[34] == lca), "")
+    return [
+        query, query_length, len(hits), len(ranked),
+        best[10], best[20], best[19], best[23], best[45], best[34], best[35],
+        ";".join(hit[10] for hit in top), ";".join(hit[20] for hit in top),
+        len(consensus), lca, lca_name, representative, identity
+    ]
+
+# splitting raw blastn tabular output into hit rows
+def hit_rows(output):
+    return [line.split('\t') for line in output.splitlines() if line.strip()]
+
+# raised instead of starting a command for a query another copy has already finished
+class TaskCancelled(Exception):
+    pass
+
+# running a shell command with a timeout, registered under key so a finished duplicate can kill it
+def run_command(command, key, input=None):
+    with task_lock:
+        if key in tasks_done:
+            raise TaskCancelled(key)
+        process = subprocess.Popen(
+            command,
+            shell=True,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            text=True,
+            start_new_session=True
+        )
+        task_processes.setdefault(key, []).append(process)
+    try:
+        stdout, stderr = process.communicate(input, timeout=task_timeout)
+    except subprocess.TimeoutExpired:
+        killing_process(process)
+        process.communicate()
+        raise
+    finally:
+        with task_lock:
+            task_processes[key].remove(process)
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, command, stdout, stderr)
+    return stdout
+
+# killing a command together with the programs its shell started
+def killing_process(process):
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+
+# running blastdbcmd and blastn for one accession, optionally restricted to a seqidlist
+def search_accession(accession, seqidlist=None, key=None):
     blastdbcmd_cmd = f"blastdbcmd -db {db_name} -entry {accession}"
     blastn_cmd = f'blastn -db {db_name} -outfmt "6 qseqid qgi qacc qaccver qlen sseqid sallseqid sgi sallgi sacc saccver sallacc slen qstart qend sstart send qseq sseq evalue bitscore score length pident nident mismatch positive gapopen gaps ppos frames qframe sframe btop staxid ssciname scomname sblastname sskingdom staxids sscinames scomnames sblastnames sskingdoms sstrand qcovs qcovhsp qcovus stitle salltitles" -max_target_seqs 10'
+    if seqidlist:
+        # keep e-values comparable with the exhaustive search by using the full database size
+        blastn_cmd += f" -seqidlist {seqidlist} -dbsize {prefilter_db_letters}"
+    blastdbcmd_output = run_command(blastdbcmd_cmd, key)
+    return run_command(blastn_cmd, key, input=blastdbcmd_output)
+
+# computing the canonical (w,k)-minimizers of a sequence
+def minimizers(sequence):
+    sequence = sequence.upper()
+    reverse = sequence.translate(complement)[::-1]
+    length = len(sequence)
+    hashes = []
+    for i in range(length - prefilter_k + 1):
+        kmer = sequence[i:i + prefilter_k]
+        reverse_kmer = reverse[length - i - prefilter_k:length - i]
+        hashes.append(hash(min(kmer, reverse_kmer)))
+    if len(hashes) <= prefilter_window:
+        return set(hashes)
+    return {min(hashes[i:i + prefilter_window]) for i in range(len(hashes) - prefilter_window + 1)}
+
+# building the minimizer index over the sequences dumped by blasting()
+def building_prefilter():
+    global prefilter_index, prefilter_accessions, prefilter_db_letters
+    print("Building minimizer index over the dumped sequences\n")
+    index = {}
+    accessions = []
+    letters = 0
+    with open_table(output_file) as read_file:
+        reader = csv.reader(read_file, delimiter='\t')
+        next(reader)
+        for row in reader:
+            ordinal = len(accessions)
+            accessions.append(row[1])
+            letters += len(row[4])
+            for minimizer in minimizers(row[4]):
+                index.setdefault(minimizer, []).append(ordinal)
+    # very frequent minimizers (conserved regions) do not discriminate between subjects
+    prefilter_index = {minimizer: postings for minimizer, postings in index.items() if len(postings) <= prefilter_max_occurrence}
+    prefilter_accessions = accessions
+    prefilter_db_letters = letters
+    os.makedirs(prefilter_dir, exist_ok=True)
+    print(f"Indexed {len(accessions)} sequences with {len(prefilter_index)} minimizers\n")
+
+# proposing the subjects sharing the most minimizers with a query sequence
+def candidate_subjects(sequence):
+    counts = Counter()
+    for minimizer in minimizers(sequence):
+        postings = prefilter_index.get(minimizer)
+        if postings:
+            counts.update(postings)
+    return [prefilter_accessions[ordinal] for ordinal, _ in counts.most_common(prefilter_candidates)]
+
+# running blastn for one accession against its candidate subjects only
+def prefiltered_search(row, key=None):
+    accession = row[1]
+    candidates = candidate_subjects(row[4])
+    if not candidates:
+        # sequence too short or too repetitive for the sketch, search everything
+        return search_accession(accession, key=key)
+    # one list per thread, a speculative copy of the same query may run concurrently
+    seqidlist = os.path.join(prefilter_dir, f"{row[0]}-{threading.get_ident()}.txt")
+    with open(seqidlist, mode="w") as f:
+        f.write("\n".join(candidates) + "\n")
     try:
-        print(f"Running blastn for accession: {accession}")
-        blastdbcmd_output = subprocess.run(
-            blastdbcmd_cmd,
-            shell=True,
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        blastn_output = subprocess.run(
-            blastn_cmd,
-            input=blastdbcmd_output.stdout,
-            shell=True,
-            check=True,
-            capture_output=True,
-            text=True
-        )
-        with blastn_lock:
-            with open(blastn_file, 'a', newline='') as f:
-                f.write(blastn_output.stdout)
-    except subprocess.CalledProcessError as e:
-        print(f"Error processing accession {accession}: {e.stderr}")
+        return search_accession(accession, seqidlist, key=key)
+    finally:
+        os.remove(seqidlist)
+
+# worker function for blastn()
+def run_blastn_for_accession(row, blastn_out, summary_out, projected_out):
+    accession = row[1]
+    start = time.time()
+    with task_lock:
+        task_started.setdefault(row[0], start)
+    print(f"Running blastn for accession: {accession}")
+    for attempt in range(task_retries + 1):
+        try:
+            if use_prefilter:
+                output = prefiltered_search(row, key=row[0])
+            else:
+                output = search_accession(accession, key=row[0])
+            break
+        except TaskCancelled:
+            # a speculative copy finished while this one was waiting to retry
+            return
+        except subprocess.TimeoutExpired:
+            # the same query would only time out again, give up on it
+            print(f"Error processing accession {accession}: timed out after {task_timeout} seconds")
+            with task_lock:
+                tasks_failed.add(row[0])
+            return
+        except subprocess.CalledProcessError as e:
+            error = e.stderr
+        if row[0] in tasks_done:
+            # killed because a speculative copy finished first
+            return
+        print(f"Error processing accession {accession} (attempt {attempt + 1}/{task_retries + 1}): {error}")
+        # a failing query is retried here, a speculative copy would only repeat the failures
+        with task_lock:
+            tasks_failed.add(row[0])
+        if attempt < task_retries:
+            time.sleep(retry_backoff * 2 ** attempt)
+    else:
+        return
+    hits = hit_rows(output)
+    members = cluster_members.get(row[0], [])
+    representative, identity = (accession, "1.0000") if use_clusters else ("", "")
+    summaries = [summarize_query(accession, row[6], hits, representative, identity)] if summary_out else []
+    projected = []
+    for member, member_identity in members:
+        member_hits = projecting_hits(member, hits)
+        # projected rows go to their own file, marked with the representative they were copied from
+        projected.extend("\t".join(hit + [accession, f"{member_identity:.4f}"]) + "\n" for hit in member_hits)
+        if summary_out:
+            summaries.append(summarize_query(member[1], member[6], member_hits, accession, f"{member_identity:.4f}"))
+    with blastn_lock:
+        if row[0] in tasks_done:
+            return
+        if blastn_out:
+            blastn_out.write(output)
+        if projected_out:
+            projected_out.writelines(projected)
+        if summary_out:
+            csv.writer(summary_out, delimiter='\t').writerows(summaries)
+        with task_lock:
+            tasks_done.add(row[0])
+            task_durations.append(time.time() - start)
+            # stop any other copy of this query that is still running
+            for process in task_processes.get(row[0], []):
+                killing_process(process)
+
+# estimating sequence identity from shared minimizers with the Mash distance
+def estimated_identity(shared, first, second):
+    jaccard = shared / (first + second - shared) if shared else 0
+    if jaccard == 0:
+        return 0.0
+    return 1 + math.log(2 * jaccard / (1 + jaccard)) / prefilter_k
+
+# greedily clustering the queries, longest first, and returning the representatives to search
+def clustering(accession_rows):
+    global cluster_members
+    print(f"Clustering sequences at {cluster_identity:.0%} estimated identity\n")
+    sketches = {}
+    index = {}
+    members = {}
+    representatives = []
+    with open(cluster_file, mode="w", newline="") as write_file:
+        writer = csv.writer(write_file, delimiter='\t')
+        writer.writerow(["accession", "representative_accession", "estimated_identity", "is_representative"])
+        for row in accession_rows:
+            sketch = minimizers(row[4])
+            counts = Counter()
+            for minimizer in sketch:
+                counts.update(index.get(minimizer, ()))
+            best, best_identity = None, 0.0
+            for ordinal, _ in counts.most_common(cluster_candidates):
+                candidate = sketches[ordinal]
+                identity = estimated_identity(len(sketch & candidate), len(sketch), len(candidate))
+                if identity >= cluster_identity and identity > best_identity:
+                    best, best_identity = ordinal, identity
+            if best is not None:
+                members[best][1].append((row, best_identity))
+                writer.writerow([row[1], members[best][0][1], f"{best_identity:.4f}", False])
+                continue
+            representatives.append(row)
+            members[row[0]] = (row, [])
+            sketches[row[0]] = sketch
+            writer.writerow([row[1], row[1], "1.0000", True])
+            for minimizer in sketch:
+                postings = index.setdefault(minimizer, [])
+                # conserved minimizers only need enough postings to rank candidates
+                if len(postings) < prefilter_max_occurrence:
+                    postings.append(row[0])
+    cluster_members = {ordinal: cluster for ordinal, (_, cluster) in members.items()}
+    identities = [identity for _, cluster in members.values() for _, identity in cluster]
+    print(f"{len(accession_rows)} sequences in {len(representatives)} clusters, blastn workload reduced {len(accession_rows) / max(len(representatives), 1):.1f}x")
+    if identities:
+        print(f"Approximation: hits for {len(identities)} members are projected from their representative (estimated identity min {min(identities):.4f}, mean {sum(identities) / len(identities):.4f})")
+    print(f"Cluster membership written to {cluster_file}\n")
+    return representatives
+
+# copying a representative's hits to a cluster member by swapping the query fields
+def projecting_hits(member, hits):
+    projected = []
+    for hit in hits:
+        hit = list(hit)
+        hit[0], hit[1], hit[2], hit[3], hit[4] = member[1], member[5], member[1], member[1], member[6]
+        projected.append(hit)
+    return projected
+
+# collecting the subject accessions reported by a blastn run
+def hit_subjects(output):
+    subjects = []
+    for line in output.splitlines():
+        fields = line.split('\t')
+        if len(fields) > 10 and fields[10] not in subjects:
+            subjects.append(fields[10])
+    return subjects
+
+# submitting the exhaustive and prefiltered searches for a sample of queries
+def submitting_recall(executor, accession_rows):
+    sample = random.Random(0).sample(accession_rows, min(prefilter_recall_sample, len(accession_rows)))
+    print(f"Checking prefilter recall against exhaustive blastn on {len(sample)} queries\n")
+    return [(row, executor.submit(search_accession, row[1]), executor.submit(prefiltered_search, row)) for row in sample]
+
+# comparing prefiltered and exhaustive top-10 hits once the sampled searches finish
+def prefilter_recall(checks):
+    recalls = []
+    identical = 0
+    with open(recall_file, mode="w", newline="") as write_file:
+        writer = csv.writer(write_file, delimiter='\t')
+        writer.writerow(["accession", "exhaustive_hits", "prefilter_hits", "shared_hits", "recall", "same_top_hit"])
+        for row, exhaustive_future, prefiltered_future in checks:
+            try:
+                exhaustive = hit_subjects(exhaustive_future.result())
+                prefiltered = hit_subjects(prefiltered_future.result())
+            except subprocess.TimeoutExpired:
+                print(f"Error checking recall for accession {row[1]}: timed out after {task_timeout} seconds")
+                continue
+            except subprocess.CalledProcessError as e:
+                print(f"Error checking recall for accession {row[1]}: {e.stderr}")
+                continue
+            shared = len(set(exhaustive) & set(prefiltered))
+            recall = shared / len(exhaustive) if exhaustive else 1.0
+            same_top_hit = exhaustive[:1] == prefiltered[:1]
+            recalls.append(recall)
+            identical += set(exhaustive) == set(prefiltered)
+            writer.writerow([row[1], len(exhaustive), len(prefiltered), shared, f"{recall:.4f}", same_top_hit])
+    if recalls:
+        print(f"Prefilter recall: mean {sum(recalls) / len(recalls):.4f}, identical top-10 for {identical}/{len(recalls)} queries")
+    print(f"Recall report written to {recall_file}\n")
+
+# waiting for the blastn tasks, re-running stragglers once the queue has drained
+def scheduling(executor, accession_rows, blastn_out, summary_out, projected_out):
+    rows = {row[0]: row for row in accession_rows}
+    pending = {executor.submit(run_blastn_for_accession, row, blastn_out, summary_out, projected_out) for row in accession_rows}
+    speculated = set()
+    while pending:
+        _, pending = concurrent.futures.wait(pending, timeout=poll_interval, return_when=concurrent.futures.FIRST_COMPLETED)
+        with task_lock:
+            durations = sorted(task_durations)
+            running = {ordinal: started for ordinal, started in task_started.items() if ordinal not in tasks_done and ordinal not in tasks_failed}
+        # speculation only helps once every task has started and workers start going idle
+        if len(durations) < speculation_min_samples or len(task_started) < len(rows):
+            continue
+        threshold = speculation_factor * durations[len(durations) // 2]
+        now = time.time()
+        for ordinal, started in running.items():
+            if ordinal not in speculated and now - started > threshold:
+                print(f"Accession {rows[ordinal][1]} running for {now - started:.0f} seconds, starting a speculative copy")
+                speculated.add(ordinal)
+                pending.add(executor.submit(run_blastn_for_accession, rows[ordinal], blastn_out, summary_out, projected_out))
 
 def blastn():
+    global taxid_parents
     print("Running blastn for each accession and appending to blastn TSV file\n")
-    blastn_file_creation()
-    with open(output_file, mode="r", newline="") as read_file:
+    write_full_hits = keep_full_hits or not summarize_hits
+    if write_full_hits:
+        blastn_file_creation()
+        if use_clusters:
+            blastn_file_creation(projected_file, ["cluster_representative", "cluster_estimated_identity"])
+    with open_table(output_file) as read_file:
         reader = csv.reader(read_file, delimiter='\t')
         accession_rows = list(reader)[1:]
-    
+    # longest queries first so the slowest searches do not start last
+    accession_rows.sort(key=lambda row: int(row[6]) if row[6].isdigit() else 0, reverse=True)
+    if use_prefilter:
+        building_prefilter()
+    if use_clusters:
+        accession_rows = clustering(accession_rows)
+    if summarize_hits:
+        taxid_parents = loading_taxonomy()
+        loading_taxdb()
+
     max_workers = 14
-    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-        futures = [executor.submit(run_blastn_for_accession, row) for row in accession_rows]
-        concurrent.futures.wait(futures)
+    try:
+        staging_database()
+        # single long-lived writers keep each compressed stream in one frame per run
+        with contextlib.ExitStack() as stack:
+            blastn_out = stack.enter_context(open_table(blastn_file, "a")) if write_full_hits else None
+            projected_out = stack.enter_context(open_table(projected_file, "a")) if write_full_hits and use_clusters else None
+            summary_out = stack.enter_context(summary_file_creation()) if summarize_hits else None
+            executor = stack.enter_context(concurrent.futures.ThreadPoolExecutor(max_workers=max_workers))
+            scheduling(executor, accession_rows, blastn_out, summary_out, projected_out)
+            print("All blastn tasks completed successfully!\n")
+            # the recall searches run on the same workers instead of one by one afterwards
+            if use_prefilter:
+                prefilter_recall(submitting_recall(executor, accession_rows))
+    finally:
+        unstaging_database()
+
+# listing the BLAST database volumes and taxonomy files blastn reads
+def database_files():
+    db_dir = os.path.dirname(db_name)
+    volume = re.compile(re.escape(os.path.basename(db_name)) + r"\.(\d+\.)?n[a-z]{2}$")
+    files = [path for path in glob.glob(f"{db_name}.*") if volume.match(os.path.basename(path))]
+    files += glob.glob(os.path.join(db_dir, "taxdb.*"))
+    return sorted(files)
+
+# reading every page of a file through mmap so it sits in the page cache
+def warming_file(path):
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as volume:
+            if hasattr(mmap, "MADV_WILLNEED"):
+                volume.madvise(mmap.MADV_WILLNEED)
+            for offset in range(0, size, mmap.PAGESIZE):
+                volume[offset]
+
+# pre-warming the database in the page cache, locking it with vmtouch when available
+def touching_database(files):
+    global vmtouch_started
+    if stage_lock_pages and shutil.which("vmtouch"):
+        print("Locking database volumes in RAM with vmtouch\n")
+        command = ["vmtouch", "-q", "-d", "-l", "-P", stage_pid_file] + files
+        result = subprocess.run(command, capture_output=True, text=True)
+        if result.returncode == 0:
+            vmtouch_started = True
+            return
+        print(f"Warning: vmtouch could not lock the database, only pre-warming it: {result.stderr}")
+    for path in files:
+        warming_file(path)
 
-    print("All blastn tasks completed successfully!\n")
+# staging the BLAST database in RAM before the blastn stage
+def staging_database():
+    global db_name, stage_dir_created, stage_run_dir_created
+    if stage_db is None:
+        return
+    files = database_files()
+    size = sum(os.path.getsize(path) for path in files)
+    print(f"Staging {len(files)} database files ({size / 2**20:.0f} MiB) with mode {stage_db}\n")
+    if stage_db in ("copy", "link"):
+        if not os.path.isdir(stage_dir):
+            os.makedirs(stage_dir)
+            stage_dir_created = True
+        try:
+            os.mkdir(stage_run_dir)
+            stage_run_dir_created = True
+        except FileExistsError:
+            # left behind by an earlier run with the same pid, never stage over it
+            print(f"Warning: {stage_run_dir} already exists, pre-warming the page cache instead")
+            touching_database(files)
+            return
+        remaining = size
+        space_checked = False
+        for path in files:
+            target = os.path.join(stage_run_dir, os.path.basename(path))
+            if stage_db == "link":
+                try:
+                    os.link(path, target)
+                    staged_files.append(target)
+                    remaining -= os.path.getsize(path)
+                    continue
+                except OSError:
+                    # /dev/shm is usually a different filesystem from the extracted database
+                    pass
+            # hard links take no space, only check once something has to be copied
+            if not space_checked:
+                space_checked = True
+                if shutil.disk_usage(stage_dir).free < remaining:
+                    print(f"Warning: not enough free space in {stage_dir}, pre-warming the page cache instead")
+                    removing_staged_files()
+                    touching_database(files)
+                    return
+            staged_files.append(target)
+            shutil.copy2(path, target)
+            remaining -= os.path.getsize(path)
+        db_name = os.path.join(stage_run_dir, os.path.basename(original_db_name))
+    else:
+        touching_database(files)
+    print(f"Database staged, blastn reads {db_name}\n")
+
+# removing the files this run staged and its run directory, and the stage directory
+# only if this run created it and no other run is still using it
+def removing_staged_files():
+    global stage_dir_created, stage_run_dir_created
+    for target in staged_files:
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+    staged_files.clear()
+    if stage_run_dir_created:
+        shutil.rmtree(stage_run_dir, ignore_errors=True)
+        stage_run_dir_created = False
+    if stage_dir_created:
+        try:
+            os.rmdir(stage_dir)
+        except OSError:
+            pass
+        stage_dir_created = False
+
+# removing the staged copy or vmtouch lock and pointing db_name back at the extracted database
+def unstaging_database():
+    global db_name, vmtouch_started
+    if stage_db is None:
+        return
+    # only stop the vmtouch daemon this run started
+    if vmtouch_started:
+        try:
+            with open(stage_pid_file) as f:
+                os.kill(int(f.read().strip()), signal.SIGTERM)
+        except (ValueError, OSError) as e:
+            print(f"Warning: could not stop vmtouch: {e}")
+        try:
+            os.remove(stage_pid_file)
+        except OSError:
+            pass
+        vmtouch_started = False
+    removing_staged_files()
+    db_name = original_db_name
+    print("Removed staged database\n")
+
+# summarizing an existing blastn file in one streaming pass
+def summarizing():
+    global taxid_parents
+    print(f"Summarizing hits per query from {blastn_file}\n")
+    taxid_parents = loading_taxonomy()
+    loading_taxdb()
+    with open_table(blastn_file) as read_file, summary_file_creation() as summary_out:
+        writer = csv.writer(summary_out, delimiter='\t')
+        next(read_file)
+        # blastn writes all hits of a query together, so grouping consecutive lines is enough
+        hits = (line.rstrip('\r\n').split('\t') for line in read_file if line.strip())
+        for query, query_hits in itertools.groupby(hits, key=lambda hit: hit[3]):
+            writer.writerow(summarize_query(query, "", list(query_hits)))
+    print(f"Per-query summary written to {summary_file}\n")
+
+# opening a streaming workbook, xlsxwriter keeps constant memory while openpyxl holds the shared strings
+# both backends write every cell as text so accessions like "0012" survive unchanged
+def opening_workbook(path):
+    if xlsxwriter is not None:
+        return xlsxwriter.Workbook(path, {"constant_memory": True, "strings_to_numbers": False, "strings_to_formulas": False, "strings_to_urls": False})
+    return openpyxl.Workbook(write_only=True)
+
+# adding a sheet to a streaming workbook
+def adding_sheet(workbook, title):
+    if xlsxwriter is not None:
+        return workbook.add_worksheet(title)
+    return workbook.create_sheet(title)
+
+# reading a cell of a numeric column as a number, None when it is empty or not a finite number
+def numeric_value(value):
+    try:
+        number = float(value)
+    except ValueError:
+        return None
+    return number if math.isfinite(number) else None
+
+# writing one row to a streaming sheet, the cells at the numeric positions as numbers and the rest as text
+def writing_xlsx_row(sheet, index, row, numeric=()):
+    numbers = [numeric_value(value) if i in numeric else None for i, value in enumerate(row)]
+    if xlsxwriter is not None:
+        for i, (value, number) in enumerate(zip(row, numbers)):
+            if number is None:
+                sheet.write(index, i, value)
+            else:
+                sheet.write_number(index, i, number)
+    else:
+        cells = []
+        for value, number in zip(row, numbers):
+            if number is None:
+                cell = WriteOnlyCell(sheet, value)
+                # openpyxl would otherwise store values starting with "=" as formulas
+                cell.data_type = "s"
+            else:
+                cell = WriteOnlyCell(sheet, number)
+            cells.append(cell)
+        sheet.append(cells)
+
+# finishing a streaming workbook on disk
+def closing_workbook(workbook, path):
+    if xlsxwriter is not None:
+        workbook.close()
+    else:
+        workbook.save(path)
+    print(f"Saved {path}")
+
+# exporting a pipeline TSV to xlsx row by row, splitting across sheets and workbooks at Excel's limits
+def exporting_xlsx(tsv_path, xlsx_path, profile="full"):
+    if xlsxwriter is None and openpyxl is None:
+        print("Error: exporting xlsx requires the xlsxwriter or openpyxl package")
+        exit(1)
+    print(f"Exporting {tsv_path} to {xlsx_path} with the {profile} column profile\n")
+    stem, extension = os.path.splitext(xlsx_path)
+    workbook = sheet = path = None
+    workbooks = sheets = 0
+    sheet_rows = xlsx_max_rows
+    truncated = 0
+    with open_table(tsv_path) as read_file:
+        reader = csv.reader(read_file, delimiter='\t')
+        header = next(reader)
+        wanted = xlsx_profiles[profile]
+        missing = [column for column in wanted or [] if column not in header]
+        if missing:
+            print(f"Error: {tsv_path} has no column(s) {', '.join(missing)} required by the {profile} profile")
+            exit(1)
+        columns = list(range(len(header))) if wanted is None else [header.index(column) for column in wanted]
+        header = [header[i] for i in columns]
+        numeric = {i for i, column in enumerate(header) if column in xlsx_numeric_columns}
+        for row in reader:
+            if sheet_rows == xlsx_max_rows:
+                if workbook is None or sheets == xlsx_max_sheets:
+                    if workbook is not None:
+                        closing_workbook(workbook, path)
+                    workbooks += 1
+                    sheets = 0
+                    path = xlsx_path if workbooks == 1 else f"{stem}-{workbooks}{extension}"
+                    workbook = opening_workbook(path)
+                sheets += 1
+                sheet = adding_sheet(workbook, f"part{sheets}")
+                writing_xlsx_row(sheet, 0, header)
+                sheet_rows = 1
+            values = [row[i] if i < len(row) else "" for i in columns]
+            for i, value in enumerate(values):
+                if len(value) > xlsx_max_cell:
+                    values[i] = value[:xlsx_max_cell]
+                    truncated += 1
+            writing_xlsx_row(sheet, sheet_rows, values, numeric)
+            sheet_rows += 1
+    if workbook is None:
+        workbook = opening_workbook(xlsx_path)
+        writing_xlsx_row(adding_sheet(workbook, "part1"), 0, header)
+        path = xlsx_path
+    closing_workbook(workbook, path)
+    if truncated:
+        print(f"Warning: truncated {truncated} cells longer than {xlsx_max_cell} characters")
+    print(f"Exported {tsv_path} into {workbooks or 1} workbook(s)\n")
 
 # moving the compressed file from Downloads to compressed_files
 def moving():
@@ -169,6 +927,8 @@ if __name__ == "__main__":
     blasting()
     adding_parent()
     blastn()
+    # summarizing()
+    # exporting_xlsx(blastn_file, f"extracted_files/{name}/{name}-blastn.xlsx", "blastn_reduced")
     # moving()
     # removing_file()
     # removing_directory()